@@ -2,12 +2,18 @@ import asyncio
 import serial_asyncio
 import serial
 import logging
+import struct
 from enum import IntEnum
-from typing import Optional, List, Union
+from typing import Dict, Optional, List, Union
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image
 import sys
 
+try:
+    from numba import njit
+except ImportError:  # Numba 为可选依赖，未安装时使用纯 Python 状态机
+    njit = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 SCREEN_DATA_LEN = 8192
@@ -20,6 +26,32 @@ if sys.platform == 'win32':
 PIXEL_WIDTH = 5
 PIXEL_HEIGHT = 7
 
+
+def _build_crc_table() -> List[int]:
+    """预计算 CRC16 (XMODEM, 多项式 0x1021) 的 256 项查找表"""
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc <<= 1
+            if crc > 0xffff:
+                crc ^= 0x1021
+                crc &= 0xffff
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE = _build_crc_table()
+
+# 字节到 8 个像素点的展开表，_BITS[b][i] 为 b 的第 i 位（从最低位开始）
+_BITS = np.array([[(b >> i) & 1 for i in range(8)] for b in range(256)], dtype=np.uint8)
+
+
+def _crc16_update(crc: int, byte: int) -> int:
+    """查表计算 CRC16，每字节一次查表"""
+    return ((crc << 8) & 0xFFFF) ^ _CRC_TABLE[((crc >> 8) ^ byte) & 0xFF]
+
+
 class Packet:
     """命令包定义"""
     Hello = 0x514
@@ -36,6 +68,10 @@ class Packet:
     ReadEeprom = 0x51B
 
 
+# 热路径中使用的命令号，避免每个数据包都查找类属性
+_GET_SCREEN = int(Packet.GetScreen)
+
+
 class Stage(IntEnum):
     """数据包解析状态"""
     Idle = 0  # 空闲状态，等待新数据包的开始标记(0xAB 或 0xB5)
@@ -78,6 +114,67 @@ class KeyCode(IntEnum):
     STOP_KEY = 19  # 停止所有按键输入
 
 
+def _feed(buf, pos, state, xor_array, data_out):
+    """从 buf[pos] 开始推进数据包解析状态机
+
+    Args:
+        buf: 接收到的字节 (uint8 数组)
+        pos: 起始位置
+        state: [stage, p_cnt, p_len]，跨调用保存的解析状态
+        xor_array: 解密用的 XOR 数组
+        data_out: 解密后的数据缓冲区
+
+    Returns:
+        (下一个位置, 数据长度)，收到完整数据包时数据长度大于 0
+    """
+    stage = state[0]
+    p_cnt = state[1]
+    p_len = state[2]
+    n = len(buf)
+    while pos < n:
+        byte = int(buf[pos])
+        pos += 1
+        if stage == Stage.Idle:
+            if byte == 0xAB:
+                stage = Stage.CD
+            elif byte == 0xB5:
+                stage = Stage.UiType
+        elif stage == Stage.CD:
+            stage = Stage.LenLSB if byte == 0xCD else Stage.Idle
+        elif stage == Stage.LenLSB:
+            p_len = byte
+            stage = Stage.LenMSB
+        elif stage == Stage.LenMSB:
+            p_len |= byte << 8
+            p_cnt = 0
+            stage = Stage.Data
+        elif stage == Stage.Data:
+            data_out[p_cnt] = byte ^ xor_array[p_cnt & 15]
+            p_cnt += 1
+            if p_cnt >= p_len:
+                stage = Stage.CrcLSB
+        elif stage == Stage.CrcLSB:
+            stage = Stage.CrcMSB
+        elif stage == Stage.CrcMSB:
+            stage = Stage.DC
+        elif stage == Stage.DC:
+            stage = Stage.BA if byte == 0xDC else Stage.Idle
+        elif stage == Stage.BA:
+            stage = Stage.Idle
+            if byte == 0xBA:
+                state[0] = stage
+                state[1] = p_cnt
+                state[2] = p_len
+                return pos, p_cnt
+    state[0] = stage
+    state[1] = p_cnt
+    state[2] = p_len
+    return n, 0
+
+
+_feed = njit(cache=True)(_feed) if njit else None
+
+
 class QuanshengProtocol(asyncio.Protocol):
     def __init__(self, comm):
         self.comm = comm
@@ -90,8 +187,7 @@ class QuanshengProtocol(asyncio.Protocol):
 
     def data_received(self, data):
         # logger.info(f"RECV={data}")
-        for byte in data:
-            self.comm.process_byte(byte)
+        self.comm.process_bytes(data)
 
     def connection_lost(self, exc):
         logger.info("Connection lost")
@@ -110,14 +206,34 @@ class QuanshengComm:
         self.p_cnt = 0
         self.is_running = True
         self.screen_data: np.ndarray = np.zeros((64, 128), dtype=np.uint8)
-        self.on_screen_update = None  # 屏幕更新回调函数
+        self.on_screen_update = None  # 屏幕更新回调函数，参数为 dirty_blocks
+        self.dirty_blocks: Optional[np.ndarray] = None  # 差分数据涉及的 (列, 行/8)，整屏数据时为 None
         self.connection_ready = asyncio.Event()
+        self._pending: Dict[int, asyncio.Future] = {}  # 等待回复的命令，键为回复命令号
+
+        # 屏幕请求合并：在途请求完成后最多补发一次
+        self._screen_inflight: Optional[asyncio.Future] = None
+        self._screen_dirty = False
+        self._screen_diff = 1
 
         # 加密用的XOR数组
         self.xor_array = bytes([
             0x16, 0x6c, 0x14, 0xe6, 0x2e, 0x91, 0x0d, 0x40,
             0x21, 0x35, 0xd5, 0x40, 0x13, 0x03, 0xe9, 0x80
         ])
+        self._xor_np = np.frombuffer(self.xor_array, dtype=np.uint8)
+        # 预先平铺的 4 KiB XOR 密钥，加密时直接切片
+        self._xor_tile = self.xor_array * 256
+        self._xor_tile_np = np.frombuffer(self._xor_tile, dtype=np.uint8)
+        # 每个密钥位置对应的 256 字节转换表，用于 bytes.translate 解密
+        self._trans = [bytes(b ^ k for b in range(256)) for k in self.xor_array]
+
+        # 发送数据包的预分配缓冲区，遇到更大的数据包时扩容
+        self._tx_buf = bytearray(4096)
+
+        # Numba 状态机使用的解析状态 [stage, p_cnt, p_len] 和数据缓冲区
+        self._rx_state = np.zeros(3, dtype=np.int64)
+        self._rx_buf = np.zeros(0x10000, dtype=np.uint8)
         logger.info(f"QuanshengComm init port={port} baudrate={baudrate}")
 
     async def connect(self):
@@ -142,132 +258,235 @@ class QuanshengComm:
         """加密/解密单个字节"""
         return byte ^ self.xor_array[xor_index & 15]
 
+    def crypt_bytes(self, data: Union[bytes, bytearray]) -> bytes:
+        """批量加密/解密，密钥从第 0 字节开始循环"""
+        payload = np.frombuffer(data, dtype=np.uint8)
+        n = len(payload)
+        if n <= len(self._xor_tile_np):
+            key = self._xor_tile_np[:n]
+        else:
+            key = np.tile(self._xor_np, (n + 15) // 16)[:n]
+        return np.bitwise_xor(payload, key).tobytes()
+
+    def crypt_translate(self, data: Union[bytes, bytearray]) -> bytearray:
+        """按密钥位置分 16 路查表加密/解密，密钥从第 0 字节开始循环"""
+        out = bytearray(data)
+        for i in range(min(16, len(out))):
+            out[i::16] = out[i::16].translate(self._trans[i])
+        return out
+
     def crc16(self, byte: int, crc: int) -> int:
         """计算CRC16"""
-        crc ^= byte << 8
-        for _ in range(8):
-            crc <<= 1
-            if crc > 0xffff:
-                crc ^= 0x1021
-                crc &= 0xffff
-        return crc
+        return _crc16_update(crc, byte)
+
+    async def send_command(self, cmd: int, *args: Union[int, bytes, List[int]],
+                           reply: Optional[int] = None, timeout: float = 1.0) -> Optional[bytearray]:
+        """异步发送命令
 
-    async def send_command(self, cmd: int, *args: Union[int, bytes, List[int]]):
-        """异步发送命令"""
+        Args:
+            cmd: 命令号
+            args: 命令参数
+            reply: 需要等待的回复命令号，为 None 时发送后立即返回
+            timeout: 等待回复的超时时间（秒）
+
+        Returns:
+            Optional[bytearray]: 回复的数据包，未等待回复或超时时返回 None
+        """
         if not self.transport:
             logger.error("No connection available")
-            return
-
-        # 构建数据包
-        data = bytearray([0xAB, 0xCD, 0x00, 0x00])
-        data.extend([cmd & 0xFF, (cmd >> 8) & 0xFF])
+            return None
 
-        # 处理参数
-        params = bytearray()
+        # 先计算参数长度：整数按数值大小取 1/2/4 字节
+        sizes = []
         for arg in args:
             if isinstance(arg, int):
-                if arg <= 0xFF:
-                    params.append(arg)
-                elif arg <= 0xFFFF:
-                    params.extend([arg & 0xFF, (arg >> 8) & 0xFF])
-                else:
-                    params.extend([
-                        arg & 0xFF,
-                        (arg >> 8) & 0xFF,
-                        (arg >> 16) & 0xFF,
-                        (arg >> 24) & 0xFF
-                    ])
+                if arg < 0:
+                    raise ValueError(f"Negative argument {arg} cannot be encoded")
+                sizes.append(1 if arg <= 0xFF else 2 if arg <= 0xFFFF else 4)
+            elif isinstance(arg, (bytes, bytearray, list)):
+                sizes.append(len(arg))
+            else:
+                sizes.append(0)
+        param_len = sum(sizes)
+
+        # 包头 8 字节 + 参数 + CRC 和包尾 4 字节，缓冲区不够时先扩容，之后的写入不会改变其大小；
+        # 末尾的 4 字节同时保证最后一个整数参数按 4 字节写入时不会越界
+        packet_len = 8 + param_len + 4
+        if len(self._tx_buf) < packet_len:
+            self._tx_buf = bytearray(packet_len)
+        buf = self._tx_buf
+
+        # 参数从包头 (0xABCD、总长度、命令、参数长度) 之后开始写入
+        pos = 8
+        for arg, size in zip(args, sizes):
+            if isinstance(arg, int):
+                # 小端写入 4 字节，只保留低位部分，多出的字节由后续写入覆盖
+                struct.pack_into('<I', buf, pos, arg & 0xFFFFFFFF)
             elif isinstance(arg, (bytes, bytearray)):
-                params.extend(arg)
+                buf[pos:pos + size] = arg
             elif isinstance(arg, list):
-                for val in arg:
-                    params.append(val & 0xFF)
+                buf[pos:pos + size] = bytes(val & 0xFF for val in arg)
+            pos += size
 
-        # 添加参数长度
-        param_len = len(params)
-        data[6:8] = [param_len & 0xFF, (param_len >> 8) & 0xFF]
-        data.extend(params)
+        # 写入包头：总长度为命令、参数长度和参数的字节数
+        struct.pack_into('<HHHH', buf, 0, 0xCDAB, param_len + 4, cmd, param_len)
 
-        # 计算CRC和加密
+        # 计算CRC
         crc = 0
-        for i in range(4, len(data)):
-            crc = self.crc16(data[i], crc)
-            data[i] = self.crypt(data[i], i - 4)
-
-        # 添加加密后的CRC
-        crc_bytes = [crc & 0xFF, (crc >> 8) & 0xFF]
-        data.extend([
-            self.crypt(crc_bytes[0], len(data) - 4),
-            self.crypt(crc_bytes[1], len(data) - 3)
-        ])
+        for byte in buf[4:pos]:
+            crc = _crc16_update(crc, byte)
+        struct.pack_into('<H', buf, pos, crc)
+        pos += 2
 
-        # 添加包尾
-        data.extend([0xDC, 0xBA])
+        # 加密数据和CRC
+        buf[4:pos] = self.crypt_bytes(buf[4:pos])
 
-        # 设置总长度
-        total_len = len(data) - 8
-        data[2:4] = [total_len & 0xFF, (total_len >> 8) & 0xFF]
+        # 添加包尾
+        buf[pos:pos + 2] = b'\xdc\xba'
+        pos += 2
+        data = bytes(buf[:pos])
+
+        # 登记等待的回复，同一回复命令共享一个 Future
+        fut = None
+        if reply is not None:
+            fut = self._pending.get(reply)
+            if fut is None or fut.done():
+                fut = asyncio.get_running_loop().create_future()
+                self._pending[reply] = fut
 
         # 异步发送数据
         self.transport.write(data)
-        logger.debug(f"SendCommand data={data}")
-        await asyncio.sleep(0.1)
-
-    def process_byte(self, byte: int):
-        """处理接收到的字节"""
-        if self.stage == Stage.Idle:
-            if byte == 0xAB:
-                self.stage = Stage.CD
-            elif byte == 0xB5:
-                self.stage = Stage.UiType
-
-        elif self.stage == Stage.CD:
-            self.stage = Stage.LenLSB if byte == 0xCD else Stage.Idle
+        logger.debug("SendCommand data=%s", data)
+        if fut is None:
+            return None
 
-        elif self.stage == Stage.LenLSB:
-            self.p_len = byte
-            self.stage = Stage.LenMSB
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Waiting for reply 0x{reply:x} timed out")
+            if self._pending.get(reply) is fut:
+                del self._pending[reply]
+            return None
 
-        elif self.stage == Stage.LenMSB:
-            self.p_len |= byte << 8
-            self.data = bytearray()
-            self.p_cnt = 0
-            self.stage = Stage.Data
+    async def request_screen(self, diff: int = 1) -> Optional[bytearray]:
+        """请求屏幕数据
 
-        elif self.stage == Stage.Data:
-            self.data.append(self.crypt(byte, self.p_cnt))
-            self.p_cnt += 1
-            if self.p_cnt >= self.p_len:
-                self.stage = Stage.CrcLSB
+        已有请求在途时不再重复发送，只标记在其完成后补发一次；
+        合并的请求中只要有一个需要整屏数据，补发时就请求整屏。
 
-        elif self.stage == Stage.CrcLSB:
-            self.stage = Stage.CrcMSB
+        Args:
+            diff: 0 请求整屏数据，1 请求差分数据
 
-        elif self.stage == Stage.CrcMSB:
-            self.stage = Stage.DC
+        Returns:
+            Optional[bytearray]: 最后一次收到的屏幕数据包，超时时返回 None
+        """
+        if self._screen_inflight is not None:
+            self._screen_dirty = True
+            if diff == 0:
+                self._screen_diff = 0
+            return await asyncio.shield(self._screen_inflight)
+
+        self._screen_inflight = asyncio.get_running_loop().create_future()
+        reply = None
+        try:
+            while True:
+                reply = await self.send_command(_GET_SCREEN, diff, reply=_GET_SCREEN)
+                if not self._screen_dirty:
+                    break
+                diff = self._screen_diff
+                self._screen_dirty = False
+                self._screen_diff = 1
+        finally:
+            self._screen_inflight.set_result(reply)
+            self._screen_inflight = None
+        return reply
+
+    def process_bytes(self, data: bytes):
+        """处理接收到的一段字节"""
+        if _feed is not None:
+            buf = np.frombuffer(data, dtype=np.uint8)
+            pos = 0
+            while pos < len(buf):
+                pos, length = _feed(buf, pos, self._rx_state, self._xor_np, self._rx_buf)
+                if length:
+                    self.parse_packet(bytearray(self._rx_buf[:length]))
+            return
 
-        elif self.stage == Stage.DC:
-            self.stage = Stage.BA if byte == 0xDC else Stage.Idle
+        # 纯 Python 状态机：解析状态、状态常量和方法都放在局部变量中，处理完后写回
+        idle, cd, len_lsb, len_msb, data_stage = Stage.Idle, Stage.CD, Stage.LenLSB, Stage.LenMSB, Stage.Data
+        crc_lsb, crc_msb, dc, ba, ui_type = Stage.CrcLSB, Stage.CrcMSB, Stage.DC, Stage.BA, Stage.UiType
+        crypt = self.crypt_translate
+        parse_packet = self.parse_packet
 
-        elif self.stage == Stage.BA:
-            self.stage = Stage.Idle
-            if byte == 0xBA:
-                self.parse_packet(self.data)
+        stage = self.stage
+        p_cnt = self.p_cnt
+        p_len = self.p_len
+        packet = self.data
+        try:
+            for byte in data:
+                if stage == idle:
+                    if byte == 0xAB:
+                        stage = cd
+                    elif byte == 0xB5:
+                        stage = ui_type
+
+                elif stage == cd:
+                    stage = len_lsb if byte == 0xCD else idle
+
+                elif stage == len_lsb:
+                    p_len = byte
+                    stage = len_msb
+
+                elif stage == len_msb:
+                    p_len |= byte << 8
+                    packet = bytearray()
+                    p_cnt = 0
+                    stage = data_stage
+
+                elif stage == data_stage:
+                    packet.append(byte)
+                    p_cnt += 1
+                    if p_cnt >= p_len:
+                        packet = crypt(packet)
+                        stage = crc_lsb
+
+                elif stage == crc_lsb:
+                    stage = crc_msb
+
+                elif stage == crc_msb:
+                    stage = dc
+
+                elif stage == dc:
+                    stage = ba if byte == 0xDC else idle
+
+                elif stage == ba:
+                    stage = idle
+                    if byte == 0xBA:
+                        parse_packet(packet)
+        finally:
+            self.stage = stage
+            self.p_cnt = p_cnt
+            self.p_len = p_len
+            self.data = packet
 
     def parse_packet(self, data: bytearray):
         """解析数据包"""
         if len(data) < 2:
             return
         cmd = data[0] | (data[1] << 8)
-        if cmd == Packet.GetScreen:
-            offset = data[2] | (data[3] << 8)
-            diff = int(data[4])
-            logger.debug(f"GetScreen offset={offset}, diff={diff}")
+        if cmd == _GET_SCREEN:
+            diff = data[4]
+            if logger.isEnabledFor(logging.DEBUG):
+                offset = data[2] | (data[3] << 8)
+                logger.debug("GetScreen offset=%d, diff=%d", offset, diff)
             self.parse_screen(data[5:], diff)
             if self.on_screen_update:
-                self.on_screen_update()
-        else:
-            pass
+                self.on_screen_update(self.dirty_blocks)
+
+        # 唤醒等待该回复的命令
+        fut = self._pending.pop(cmd, None)
+        if fut and not fut.done():
+            fut.set_result(data)
 
     def parse_screen(self, data: bytearray, diff) -> np.ndarray:
         """
@@ -284,30 +503,30 @@ class QuanshengComm:
         if len(data) % 3 != 0:
             raise ValueError("数据长度必须是 3 的整数倍")
 
-        # 创建 128x64 的零矩阵
-        screen = np.zeros((64, 128), dtype=np.uint8) if diff == 0 else self.screen_data
+        # 整屏数据时创建 128x64 的零矩阵，差分数据直接在原矩阵上修改
+        if diff == 0:
+            self.screen_data = np.zeros((64, 128), dtype=np.uint8)
+        screen = self.screen_data
 
-        # 每次处理 3 个字节
-        for i in range(0, len(data), 3):
-            # 获取三个字节
-            pixels = data[i]  # 8 个像素点的状态（从下到上）
-            col = data[i + 1]  # 列号 (0-127)
-            row = (data[i + 2] * 8)  # 起始行号
+        # 每 3 个字节一组：8 个像素点的状态（从下到上）、列号 (0-127)、起始行号 / 8
+        arr = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+        pix = arr[:, 0]
+        col = arr[:, 1]
+        row8 = arr[:, 2]
 
-            # 检查坐标是否有效
-            if col >= 128 or row >= 64:
-                continue
+        # 过滤无效坐标
+        valid = (col < 128) & (row8 < 8)
 
-            # 处理 8 个像素点
-            for bit in range(8):
-                pixel_row = row + bit  # 实际的行号
-                if pixel_row >= 64:  # 确保不超出边界
-                    break
+        # 查表展开 8 个像素点，一次性写入
+        bits = _BITS[pix[valid]]
+        rows = row8[valid, None].astype(np.intp) * 8 + np.arange(8)
+        screen[rows, col[valid, None]] = bits
 
-                # 从最低位开始，获取每一位的值
-                is_lit = (pixels >> bit) & 1
-                screen[pixel_row, col] = is_lit
-        self.screen_data = screen
+        # 记录差分数据涉及的 8 像素列块
+        if diff == 0:
+            self.dirty_blocks = None
+        else:
+            self.dirty_blocks = np.unique(np.stack([col[valid], row8[valid]], axis=1), axis=0)
         return screen
 
     async def close(self):
@@ -323,8 +542,8 @@ class QuanshengComm:
             except Exception as e:
                 logger.error(f"Error closing connection: {e}")
 
-    def export_screen(self, filename: str = "screen.png") -> bool:
-        """将 screen_data (ndarray) 保存为图像文件
+    async def export_screen(self, filename: str = "screen.png") -> bool:
+        """将 screen_data (ndarray) 异步保存为图像文件，PNG 编码在工作线程中进行
 
         Args:
             filename: 要保存的图像文件路径，默认为 "screen.png"
@@ -339,28 +558,16 @@ class QuanshengComm:
 
 
 
-            # 计算新的图像尺寸
-            width = 128 * PIXEL_WIDTH
-            height = 64 * PIXEL_HEIGHT
-
-            # 创建新图像
-            image = Image.new("RGB", (width, height), "white")
-            draw = ImageDraw.Draw(image)
+            # 将每个像素放大为 PIXEL_HEIGHT x PIXEL_WIDTH 的色块
+            big = np.repeat(np.repeat(self.screen_data, PIXEL_HEIGHT, axis=0), PIXEL_WIDTH, axis=1)
 
-            # 绘制每个像素
-            for y in range(64):
-                for x in range(128):
-                    if self.screen_data[y, x]:  # 使用 numpy 数组的索引方式
-                        # 计算放大后的矩形坐标
-                        x1 = x * PIXEL_WIDTH
-                        y1 = y * PIXEL_HEIGHT
-                        x2 = x1 + PIXEL_WIDTH - 1
-                        y2 = y1 + PIXEL_HEIGHT - 1
-                        # 绘制黑色矩形
-                        draw.rectangle([x1, y1, x2, y2], fill="black")
+            # 点亮为黑色，其余为白色
+            gray = np.where(big, 0, 255).astype(np.uint8)
+            rgb = np.repeat(gray[:, :, None], 3, axis=2)
+            image = Image.fromarray(rgb, "RGB")
 
             # 保存图像
-            image.save(filename)
+            await asyncio.to_thread(image.save, filename)
             logger.info(f"Screen image saved to {filename}")
             return True
 
@@ -1,21 +1,37 @@
 import sys
 import asyncio
 from PyQt6 import QtWidgets, uic
-from PyQt6.QtCore import Qt, QTimer
+from PyQt6.QtCore import QTimer
 from PyQt6.QtWidgets import QMessageBox, QInputDialog
-from PyQt6.QtGui import QPixmap, QImage, QColor
+from PyQt6.QtGui import QPixmap, QImage, QPainter
 import serial.tools.list_ports
-from comm import QuanshengComm, KeyCode, Packet
+import numpy as np
+from comm import QuanshengComm, KeyCode, Packet, PIXEL_WIDTH, PIXEL_HEIGHT
 import qasync
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 松开按键时发送的停止按键码，避免每次释放都解析枚举属性
+_STOP_KEY = int(KeyCode.STOP_KEY)
+
+# KeyPress 没有回复，发送后需等待对讲机处理按键并重绘屏幕，再请求差分屏幕数据
+KEY_PRESS_SETTLE = 0.5
+KEY_RELEASE_SETTLE = 0.1
+
+# 屏幕背景色和点亮像素颜色
+SCREEN_BG_COLOR = (255, 170, 0)
+SCREEN_FG_COLOR = (0, 0, 0)
+
 
 class RadioWindow(QtWidgets.QMainWindow):
     def __init__(self):
         super().__init__()
         self.button_map = {}
+        # 缓存上一帧的放大后像素和 RGB 缓冲区，只更新变化的像素
+        self._screen_mask = None
+        self._screen_rgb = None
+        self._screen_image = None
         uic.loadUi('radio.ui', self)
         
         # 获取可用COM口
@@ -49,7 +65,7 @@ class RadioWindow(QtWidgets.QMainWindow):
         logger.info("初始化通信连接")
         if await self.comm.connect():
             await asyncio.sleep(1)  # 确保连接稳定
-            await self.comm.send_command(Packet.GetScreen, 0)
+            await self.comm.request_screen(0)
         else:
             QMessageBox.critical(self, "错误", "无法连接到对讲机")
             sys.exit(1)
@@ -93,64 +109,93 @@ class RadioWindow(QtWidgets.QMainWindow):
         
     async def refresh_command(self):
         """刷新屏幕命令"""
-        try:
-            await asyncio.wait_for(self.comm.send_command(Packet.GetScreen, 0), timeout=1)
-            await asyncio.sleep(0.5)  # 减少延迟时间
-        except asyncio.TimeoutError:
+        if await self.comm.request_screen(0) is None:
             logger.warning("屏幕刷新超时")
 
     async def button_pressed(self, key_code):
         """按键按下事件"""
         await self.comm.send_command(Packet.KeyPress, key_code)
-        await asyncio.sleep(0.5)
-        await self.loop.create_task(self.comm.send_command(Packet.GetScreen, 1))
+        await asyncio.sleep(KEY_PRESS_SETTLE)  # 等待对讲机处理按键并重绘
+        await self.comm.request_screen(1)
 
 
     async def button_released(self, key_code):
         """按键释放事件"""
         # await self.comm.send_command(Packet.KeyPress, key_code)
         # await asyncio.sleep(0.1)
-        await self.comm.send_command(Packet.KeyPress, KeyCode.STOP_KEY)
-        await asyncio.sleep(0.1)
-        await self.loop.create_task(self.comm.send_command(Packet.GetScreen, 1))
+        await self.comm.send_command(Packet.KeyPress, _STOP_KEY)
+        await asyncio.sleep(KEY_RELEASE_SETTLE)  # 等待对讲机处理按键并重绘
+        await self.comm.request_screen(1)
+
 
+    def refresh_screen(self, blocks=None):
+        """刷新屏幕显示
 
-    def refresh_screen(self):
-        """刷新屏幕显示"""
+        Args:
+            blocks: 差分数据涉及的 (列, 行/8) 数组，为 None 时整屏刷新
+        """
         if self.comm.screen_data is None:
             return
             
         try:
-            # 定义像素大小
-            PIXEL_WIDTH = 5
-            PIXEL_HEIGHT = 7
-            
-            # 计算新的图像尺寸 (注意 screen_data 现在是 64x128 的 ndarray)
-            width = 128 * PIXEL_WIDTH
-            height = 64 * PIXEL_HEIGHT
-            image = QImage(width, height, QImage.Format.Format_RGB888)
-            
-            # 填充白色背景
-            image.fill(QColor(255, 170, 0))
-            
-            # 绘制放大后的像素
-            for y in range(64):
-                for x in range(128):
-                    if self.comm.screen_data[y, x]:  # 使用 numpy 数组的索引方式
-                        # 如果点是黑色，填充对应的矩形区域
-                        for py in range(PIXEL_HEIGHT):
-                            for px in range(PIXEL_WIDTH):
-                                image.setPixelColor(
-                                    x * PIXEL_WIDTH + px,
-                                    y * PIXEL_HEIGHT + py,
-                                    Qt.GlobalColor.black
-                                )
-            
+            if blocks is None or self._screen_image is None:
+                self.redraw_screen()
+            else:
+                self.redraw_blocks(blocks)
+
             # 使用 QTimer 延迟更新 UI，避免阻塞主线程
+            image = QImage(self._screen_image)
             QTimer.singleShot(0, lambda: self.update_ui(image))
         except Exception as e:
             logger.error(f"屏幕刷新错误: {e}")
 
+    def redraw_screen(self):
+        """重绘整个屏幕图像"""
+        # 计算新的图像尺寸 (注意 screen_data 现在是 64x128 的 ndarray)
+        width = 128 * PIXEL_WIDTH
+        height = 64 * PIXEL_HEIGHT
+
+        # 将每个像素放大为 PIXEL_HEIGHT x PIXEL_WIDTH 的色块
+        mask = np.repeat(np.repeat(self.comm.screen_data, PIXEL_HEIGHT, 0), PIXEL_WIDTH, 1).astype(bool)
+
+        if self._screen_rgb is None:
+            # 首帧：填充背景后绘制全部点亮的像素
+            self._screen_rgb = np.empty((height, width, 3), dtype=np.uint8)
+            self._screen_rgb[...] = SCREEN_BG_COLOR
+            self._screen_rgb[mask] = SCREEN_FG_COLOR
+        else:
+            # 后续帧：只覆盖与上一帧不同的像素
+            changed = mask != self._screen_mask
+            self._screen_rgb[changed & mask] = SCREEN_FG_COLOR
+            self._screen_rgb[changed & ~mask] = SCREEN_BG_COLOR
+        self._screen_mask = mask
+
+        rgb = self._screen_rgb
+        self._screen_image = QImage(rgb.data, width, height, 3 * width, QImage.Format.Format_RGB888).copy()
+
+    def redraw_blocks(self, blocks):
+        """只重绘差分数据涉及的 8 像素列块"""
+        tile = np.ones((PIXEL_HEIGHT, PIXEL_WIDTH), dtype=np.uint8)
+        painter = QPainter(self._screen_image)
+        try:
+            for col, row8 in blocks.tolist():
+                row = row8 * 8
+                mask = np.kron(self.comm.screen_data[row:row + 8, col, None], tile).astype(bool)
+                h, w = mask.shape
+                y = row * PIXEL_HEIGHT
+                x = col * PIXEL_WIDTH
+
+                # 同步更新缓存的像素和 RGB 缓冲区
+                self._screen_mask[y:y + h, x:x + w] = mask
+                sub = self._screen_rgb[y:y + h, x:x + w]
+                sub[mask] = SCREEN_FG_COLOR
+                sub[~mask] = SCREEN_BG_COLOR
+
+                sub = np.ascontiguousarray(sub)
+                painter.drawImage(x, y, QImage(sub.data, w, h, 3 * w, QImage.Format.Format_RGB888))
+        finally:
+            painter.end()
+
     def update_ui(self, image):
         """更新 UI"""
         if self.screenView.scene() is None: